@@ -1,18 +1,29 @@
-from fastapi import APIRouter, Query, HTTPException, Request
+from fastapi import APIRouter, Query, HTTPException, Request, BackgroundTasks
 import psycopg2
 import os
 from dotenv import load_dotenv
 import openai
 import json
+from datetime import date
+from typing import Optional
 from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
 from app.services.gmail_service import (
     authenticate_gmail,
     list_labels,
     search_messages,
-    is_authenticated
+    is_authenticated,
+    extract_plain_text,
+    summarize_stored_emails
 )
 import base64
 from app.services.openai_service import get_summary
+from app.services.archive_service import read_email_body
+from app.services.embedding_service import semantic_search
+from app.services.digest_service import get_digest
+from app.services.attachment_service import collect_attachment_parts, load_message_attachment_text
+from app.services.llm_queue import dispatcher, INTERACTIVE, LLMJobExpired
+from app.utils.singleflight import SingleFlight
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow, Flow
 
@@ -33,6 +44,12 @@ openai.api_key = os.getenv('OPENAI_API_KEY')
 
 router = APIRouter()
 
+# Concurrent identical requests share one Gmail fetch / OpenAI call
+summarize_flight = SingleFlight("summarize")
+search_flight = SingleFlight("search")
+# One summarization run per digest date, however many refreshes are requested while it runs
+digest_flight = SingleFlight("digest")
+
 @router.get("/")
 def read_root():
     return {"message": "Hello from API"}
@@ -56,12 +73,11 @@ def get_email_content(email_id):
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         cur = conn.cursor()
-        cur.execute("SELECT body FROM emails WHERE id = %s", (email_id,))
-        email_body = cur.fetchone()
+        email_body = read_email_body(cur, email_id)
         cur.close()
         conn.close()
-        if email_body:
-            return email_body[0]
+        if email_body is not None:
+            return email_body
         else:
             raise HTTPException(status_code=404, detail="Email not found.")
     except Exception as e:
@@ -81,7 +97,8 @@ def summarize_content(email_body):
         prompt = f"Provide a brief summary of the key points from this email:\n{email_body}"
         
         print("Making OpenAI API call...")
-        response = openai.ChatCompletion.create(
+        response = dispatcher.complete(
+            INTERACTIVE,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "Create a concise summary focusing only on the most important points."},
@@ -114,9 +131,8 @@ def summarize_content(email_body):
         print(f"Error during summarization: {str(e)}")
         raise Exception(f"Summarization failed: {str(e)}")
 
-@router.get("/search-emails/")
-async def search_emails(query: str = Query(..., description="Search query for emails")):
-    """Search emails by sender or subject."""
+def run_email_search(query):
+    """Search the Gmail newsletter folder by sender, subject or body."""
     try:
         print(f"Starting search with query: {query}")  # Debug log
         
@@ -174,19 +190,93 @@ async def search_emails(query: str = Query(..., description="Search query for em
         print(f"Unexpected error in search_emails: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/summarize-email/")
-async def summarize_email(email_id: str):
-    """Summarize the content of a specific email."""
+@router.get("/search-emails/")
+async def search_emails(query: str = Query(..., description="Search query for emails")):
+    """Search emails by sender or subject."""
+    # search_messages lowercases and strips the query, so these variants share one result
+    key = query.lower().strip()
+    return await search_flight.do(key, lambda: run_in_threadpool(run_email_search, query))
+
+# Plain def: FastAPI runs it in the threadpool, so index refreshes and DB calls never block the event loop
+@router.get("/semantic-search/")
+def semantic_search_emails(
+    query: str = Query(..., description="Natural language search query"),
+    top_k: int = Query(10, ge=1, le=100, description="Number of results to return"),
+    hybrid: bool = Query(True, description="Boost results that also match sender or subject")
+):
+    """Search stored emails by meaning rather than exact substrings."""
     try:
-        # Get Gmail service
-        service = authenticate_gmail()
-        
-        # Get the full email content
-        message = service.users().messages().get(
-            userId='me',
-            id=email_id,
-            format='full'
-        ).execute()
+        keyword_ids = {email['id'] for email in get_email_list(query)} if hybrid else None
+        results = semantic_search(query, top_k=top_k, keyword_ids=keyword_ids)
+        if not results:
+            return []
+
+        scores = dict(results)
+        conn = psycopg2.connect(**DB_CONFIG)
+        cur = conn.cursor()
+        cur.execute("SELECT id, sender, subject, received_at FROM emails WHERE id = ANY(%s)",
+                    (list(scores),))
+        emails = {row[0]: row for row in cur.fetchall()}
+        cur.close()
+        conn.close()
+
+        return [
+            {
+                "id": email_id,
+                "sender": emails[email_id][1],
+                "subject": emails[email_id][2],
+                "received_at": emails[email_id][3],
+                "score": score
+            }
+            for email_id, score in results if email_id in emails
+        ]
+    except HTTPException as he:
+        raise he
+    except Exception as e:
+        print(f"Error in semantic_search_emails: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/daily-digest/")
+def daily_digest(digest_date: Optional[date] = Query(None, alias="date", description="Day to read, defaults to today")):
+    """Return the precomputed cross-newsletter digest for a day."""
+    try:
+        return get_digest(digest_date)
+    except Exception as e:
+        print(f"Error in daily_digest: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/daily-digest/refresh")
+async def refresh_daily_digest(
+    background_tasks: BackgroundTasks,
+    digest_date: Optional[date] = Query(None, alias="date", description="Day to refresh, defaults to today")
+):
+    """Summarize the day's unsummarized stored emails in the background and update its digest.
+
+    A refresh requested while one for the same date is running joins it instead
+    of summarizing the same emails again.
+    """
+    digest_date = digest_date or date.today()
+    background_tasks.add_task(
+        digest_flight.do,
+        digest_date.isoformat(),
+        lambda: run_in_threadpool(summarize_stored_emails, digest_date)
+    )
+    return {"message": "Digest refresh started"}
+
+def fetch_gmail_message(service, email_id):
+    """Fetch the full Gmail message for an email ID."""
+    return service.users().messages().get(
+        userId='me',
+        id=email_id,
+        format='full'
+    ).execute()
+
+async def run_email_summary(email_id):
+    """Fetch an email from Gmail and summarize it."""
+    try:
+        # Authenticate and get the full email content without blocking the event loop
+        service = await run_in_threadpool(authenticate_gmail)
+        message = await run_in_threadpool(fetch_gmail_message, service, email_id)
 
         # Extract headers
         headers = message.get('payload', {}).get('headers', [])
@@ -196,13 +286,20 @@ async def summarize_email(email_id: str):
         body = ""
         if 'parts' in message.get('payload', {}):
             for part in message['payload']['parts']:
-                if part.get('mimeType') == 'text/plain':
+                if part.get('mimeType') == 'text/plain' and part.get('body', {}).get('data'):
                     body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
                     break
         elif 'body' in message.get('payload', {}):
             if 'data' in message['payload']['body']:
                 body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
 
+        # Fall back to nested or HTML-only parts, then to content held in attachments
+        if not body:
+            body = extract_plain_text(message.get('payload', {}))
+        if not body:
+            parts = collect_attachment_parts(message.get('payload', {}))
+            body = await run_in_threadpool(load_message_attachment_text, service, email_id, parts)
+
         if not body:
             raise HTTPException(status_code=400, detail="No email content found to summarize")
 
@@ -210,10 +307,32 @@ async def summarize_email(email_id: str):
         summary = await get_summary(subject, body)
         return {"summary": summary}
 
+    except LLMJobExpired as e:
+        print(f"Summary request expired in the LLM queue: {str(e)}")  # Debug log
+        raise HTTPException(status_code=503, detail="Summarization is busy, please try again")
     except Exception as e:
         print(f"Error in summarize_email: {str(e)}")  # Debug log
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/summarize-email/")
+async def summarize_email(email_id: str):
+    """Summarize the content of a specific email."""
+    return await summarize_flight.do(email_id, lambda: run_email_summary(email_id))
+
+@router.get("/coalescing-stats")
+async def coalescing_stats():
+    """Report how many summarize and search calls were served by an in-flight request."""
+    return {
+        "summarize": summarize_flight.stats(),
+        "search": search_flight.stats(),
+        "digest": digest_flight.stats(),
+    }
+
+@router.get("/llm-stats")
+async def llm_stats():
+    """Report LLM queue depth, token budget and per-priority latency."""
+    return dispatcher.stats()
+
 @router.post("/logout")
 async def logout():
     try:
@@ -0,0 +1,110 @@
+import os
+import psycopg2
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Database credentials from environment variables
+DB_CONFIG = {
+    'dbname': os.getenv('DB_NAME'),
+    'user': os.getenv('DB_USER'),
+    'password': os.getenv('DB_PASSWORD'),
+    'host': os.getenv('DB_HOST'),
+    'port': os.getenv('DB_PORT'),
+}
+
+# Arbitrary key so concurrent workers starting up apply the schema one at a time
+SCHEMA_LOCK_KEY = 7201
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS emails (
+        id SERIAL PRIMARY KEY,
+        sender TEXT,
+        subject TEXT,
+        body TEXT,
+        received_at TIMESTAMP DEFAULT NOW()
+    );
+
+    -- Compressed archive of cold email bodies
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS archived BOOLEAN NOT NULL DEFAULT FALSE;
+    CREATE TABLE IF NOT EXISTS sender_dictionaries (
+        id SERIAL PRIMARY KEY,
+        sender TEXT NOT NULL,
+        dictionary BYTEA NOT NULL,
+        created_at TIMESTAMP DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS sender_dictionaries_sender_idx ON sender_dictionaries (sender);
+    CREATE TABLE IF NOT EXISTS email_archive (
+        email_id INTEGER PRIMARY KEY REFERENCES emails (id) ON DELETE CASCADE,
+        dictionary_id INTEGER REFERENCES sender_dictionaries (id),
+        body_compressed BYTEA NOT NULL,
+        original_size INTEGER NOT NULL
+    );
+
+    -- Semantic search; version is bumped on every write so the in-process index can catch up
+    CREATE SEQUENCE IF NOT EXISTS email_embeddings_version_seq;
+    CREATE TABLE IF NOT EXISTS email_embeddings (
+        email_id INTEGER PRIMARY KEY REFERENCES emails (id) ON DELETE CASCADE,
+        features BYTEA NOT NULL,
+        version BIGINT NOT NULL DEFAULT nextval('email_embeddings_version_seq')
+    );
+    CREATE INDEX IF NOT EXISTS email_embeddings_version_idx ON email_embeddings (version);
+    -- Rows written before the current EMBEDDING_FORMAT are re-embedded by the backfill
+    ALTER TABLE email_embeddings ADD COLUMN IF NOT EXISTS format SMALLINT NOT NULL DEFAULT 1;
+
+    -- Daily digest
+    ALTER TABLE emails ADD COLUMN IF NOT EXISTS summary TEXT;
+    CREATE TABLE IF NOT EXISTS digest_clusters (
+        id SERIAL PRIMARY KEY,
+        digest_date DATE NOT NULL,
+        -- Unnormalised sum of member vectors; centroid direction is vector_sum / |vector_sum|
+        vector_sum BYTEA NOT NULL,
+        size INTEGER NOT NULL,
+        headline_email_id INTEGER REFERENCES emails (id) ON DELETE SET NULL,
+        updated_at TIMESTAMP DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS digest_clusters_date_idx ON digest_clusters (digest_date);
+    CREATE TABLE IF NOT EXISTS digest_cluster_members (
+        email_id INTEGER PRIMARY KEY REFERENCES emails (id) ON DELETE CASCADE,
+        cluster_id INTEGER NOT NULL REFERENCES digest_clusters (id) ON DELETE CASCADE,
+        similarity REAL NOT NULL
+    );
+
+    -- Lazily loaded attachments
+    CREATE TABLE IF NOT EXISTS email_attachments (
+        id SERIAL PRIMARY KEY,
+        email_id INTEGER REFERENCES emails (id) ON DELETE CASCADE,
+        message_id TEXT NOT NULL,
+        part_id TEXT NOT NULL,
+        attachment_id TEXT NOT NULL,
+        filename TEXT,
+        mime_type TEXT,
+        size INTEGER,
+        content_hash TEXT,
+        UNIQUE (message_id, part_id)
+    );
+    CREATE TABLE IF NOT EXISTS attachment_text (
+        content_hash TEXT PRIMARY KEY,
+        text TEXT NOT NULL
+    );
+"""
+
+def ensure_schema():
+    """Create every table and column the app needs if they are missing.
+
+    Run once at startup (and by the command-line jobs) so request handlers never
+    issue DDL. Every statement is idempotent.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_KEY,))
+        cur.execute(SCHEMA)
+        conn.commit()
+        cur.close()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
@@ -0,0 +1,182 @@
+import os
+import zlib
+from collections import Counter
+import psycopg2
+from dotenv import load_dotenv
+from app.models.schema import DB_CONFIG, ensure_schema
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Emails older than this are moved out of the hot table into the archive
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '30'))
+
+# zlib only looks back 32KB, so a larger preset dictionary is wasted
+MAX_DICTIONARY_SIZE = 32 * 1024
+DICTIONARY_SAMPLE_SIZE = 50
+COMPRESSION_LEVEL = 9
+ARCHIVE_BATCH_SIZE = 500
+
+# Dictionaries never change once trained, so they can be cached for the life of the process
+_dictionary_cache = {}
+
+def train_dictionary(bodies):
+    """Build a zlib preset dictionary from sample bodies of a single sender.
+
+    Lines that repeat across issues (headers, footers, unsubscribe blurbs, layout
+    boilerplate) are kept, with the most frequent ones placed last because zlib
+    encodes matches closer to the end of the dictionary more cheaply.
+    """
+    line_counts = Counter()
+    for body in bodies:
+        # Count each line once per body so a single long email cannot dominate
+        line_counts.update(set(line.strip() for line in body.splitlines() if line.strip()))
+
+    shared_lines = [line for line, count in line_counts.items() if count > 1]
+    shared_lines.sort(key=lambda line: line_counts[line])
+
+    dictionary = "\n".join(shared_lines).encode('utf-8')
+    return dictionary[-MAX_DICTIONARY_SIZE:]
+
+def compress_body(body, dictionary=b""):
+    """Compress an email body, optionally with a sender's preset dictionary."""
+    if dictionary:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    return compressor.compress(body.encode('utf-8')) + compressor.flush()
+
+def decompress_body(data, dictionary=b""):
+    """Restore an email body compressed by compress_body."""
+    if dictionary:
+        decompressor = zlib.decompressobj(zdict=dictionary)
+    else:
+        decompressor = zlib.decompressobj()
+    return (decompressor.decompress(bytes(data)) + decompressor.flush()).decode('utf-8')
+
+def get_dictionary(cur, dictionary_id):
+    """Return the preset dictionary with the given ID, using the in-process cache."""
+    if dictionary_id is None:
+        return b""
+    if dictionary_id not in _dictionary_cache:
+        cur.execute("SELECT dictionary FROM sender_dictionaries WHERE id = %s", (dictionary_id,))
+        row = cur.fetchone()
+        _dictionary_cache[dictionary_id] = bytes(row[0]) if row else b""
+    return _dictionary_cache[dictionary_id]
+
+def get_or_train_dictionary(cur, sender):
+    """Return (dictionary_id, dictionary) for a sender, training one on first use."""
+    cur.execute("""
+        SELECT id FROM sender_dictionaries
+        WHERE sender = %s
+        ORDER BY created_at DESC
+        LIMIT 1
+    """, (sender,))
+    row = cur.fetchone()
+    if row:
+        return row[0], get_dictionary(cur, row[0])
+
+    # Train on the sender's most recent bodies that are still in the hot table
+    cur.execute("""
+        SELECT body FROM emails
+        WHERE sender = %s AND NOT archived AND body IS NOT NULL
+        ORDER BY received_at DESC
+        LIMIT %s
+    """, (sender, DICTIONARY_SAMPLE_SIZE))
+    dictionary = train_dictionary([r[0] for r in cur.fetchall()])
+    if not dictionary:
+        return None, b""
+
+    cur.execute("""
+        INSERT INTO sender_dictionaries (sender, dictionary)
+        VALUES (%s, %s)
+        RETURNING id;
+    """, (sender, psycopg2.Binary(dictionary)))
+    dictionary_id = cur.fetchone()[0]
+    _dictionary_cache[dictionary_id] = dictionary
+    return dictionary_id, dictionary
+
+def read_email_body(cur, email_id):
+    """Return the body of an email whether it lives in the hot table or the archive.
+
+    Returns None when no email with the given ID exists.
+    """
+    cur.execute("""
+        SELECT e.body, a.body_compressed, a.dictionary_id
+        FROM emails e
+        LEFT JOIN email_archive a ON a.email_id = e.id
+        WHERE e.id = %s
+    """, (email_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+
+    body, body_compressed, dictionary_id = row
+    if body_compressed is None:
+        return body
+    return decompress_body(body_compressed, get_dictionary(cur, dictionary_id))
+
+def archive_emails(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move bodies of emails older than the cutoff into the compressed archive.
+
+    The hot `emails` row keeps its metadata and is flagged as archived, its body is
+    cleared, and the compressed copy lives in `email_archive`. Cold bodies are
+    streamed through a server-side cursor and committed batch by batch, so memory
+    and lock time stay bounded however large the backlog is.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        # WITH HOLD keeps the server-side cursor open across the per-batch commits
+        scan = conn.cursor(name='archive_scan', withhold=True)
+        scan.itersize = batch_size
+        scan.execute("""
+            SELECT id, sender, body FROM emails
+            WHERE NOT archived AND body IS NOT NULL
+              AND received_at < NOW() - make_interval(days => %s)
+            ORDER BY sender, id
+        """, (older_than_days,))
+        cur = conn.cursor()
+
+        archived = original_bytes = compressed_bytes = 0
+        dictionaries = {}
+        while True:
+            rows = scan.fetchmany(batch_size)
+            if not rows:
+                break
+
+            for email_id, sender, body in rows:
+                if sender not in dictionaries:
+                    dictionaries[sender] = get_or_train_dictionary(cur, sender)
+                dictionary_id, dictionary = dictionaries[sender]
+
+                compressed = compress_body(body, dictionary)
+                original_size = len(body.encode('utf-8'))
+                original_bytes += original_size
+                compressed_bytes += len(compressed)
+
+                cur.execute("""
+                    INSERT INTO email_archive (email_id, dictionary_id, body_compressed, original_size)
+                    VALUES (%s, %s, %s, %s);
+                """, (email_id, dictionary_id, psycopg2.Binary(compressed), original_size))
+                cur.execute("UPDATE emails SET body = NULL, archived = TRUE WHERE id = %s;", (email_id,))
+
+            conn.commit()
+            archived += len(rows)
+            print(f"Archived {archived} emails so far: {original_bytes} -> {compressed_bytes} bytes")
+
+        scan.close()
+        cur.close()
+        if not archived:
+            print("No emails to archive.")
+        return archived
+
+    except Exception as e:
+        conn.rollback()
+        print(f"Archive error: {e}")
+        raise
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    ensure_schema()
+    archive_emails()
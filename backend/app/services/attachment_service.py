@@ -0,0 +1,182 @@
+import os
+import io
+import base64
+import hashlib
+import psycopg2
+from bs4 import BeautifulSoup
+from dotenv import load_dotenv
+from pypdf import PdfReader
+from app.models.schema import DB_CONFIG
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Inline text parts are preferred over documents when looking for summarizable content
+INLINE_MIME_TYPES = ['text/plain', 'text/html']
+SUPPORTED_MIME_TYPES = INLINE_MIME_TYPES + ['application/pdf']
+
+# Attachments larger than this are never downloaded
+MAX_ATTACHMENT_BYTES = int(os.getenv('MAX_ATTACHMENT_BYTES', str(10 * 1024 * 1024)))
+# Extraction stops once this much text is collected; the summarizer only reads the start anyway
+MAX_TEXT_CHARS = 20000
+
+def collect_attachment_parts(payload):
+    """List the parts of a payload whose content must be fetched via attachmentId.
+
+    This covers real attachments as well as large inline text/html parts, which
+    Gmail also moves out of the message body.
+    """
+    parts = []
+    if 'parts' in payload:
+        for part in payload['parts']:
+            parts.extend(collect_attachment_parts(part))
+    else:
+        body = payload.get('body', {})
+        if body.get('attachmentId'):
+            parts.append({
+                'part_id': payload.get('partId', ''),
+                'attachment_id': body['attachmentId'],
+                'filename': payload.get('filename', ''),
+                'mime_type': payload.get('mimeType', ''),
+                'size': body.get('size', 0),
+            })
+    return parts
+
+def record_attachment_parts(cur, email_id, message_id, parts):
+    """Store attachment metadata at sync time so the bytes can be fetched later."""
+    if not parts:
+        return
+    for part in parts:
+        cur.execute("""
+            INSERT INTO email_attachments (email_id, message_id, part_id, attachment_id, filename, mime_type, size)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (message_id, part_id) DO UPDATE
+            SET email_id = EXCLUDED.email_id, attachment_id = EXCLUDED.attachment_id;
+        """, (email_id, message_id, part['part_id'], part['attachment_id'],
+              part['filename'], part['mime_type'], part['size']))
+
+def extract_text(data, mime_type):
+    """Extract at most MAX_TEXT_CHARS of text from attachment bytes."""
+    if mime_type == 'application/pdf':
+        # Read page by page so large documents stop as soon as there is enough text
+        text = ""
+        for page in PdfReader(io.BytesIO(data)).pages:
+            text += (page.extract_text() or "") + "\n"
+            if len(text) >= MAX_TEXT_CHARS:
+                break
+        return text[:MAX_TEXT_CHARS].strip()
+
+    decoded = data.decode('utf-8', errors='ignore')
+    if mime_type == 'text/html':
+        decoded = BeautifulSoup(decoded, 'html.parser').get_text()
+    return decoded[:MAX_TEXT_CHARS].strip()
+
+def _db_call(fn, *args):
+    """Run a cache lookup or write, treating database errors as a cache miss."""
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        cur = conn.cursor()
+        result = fn(cur, *args)
+        conn.commit()
+        cur.close()
+        conn.close()
+        return result
+    except Exception as e:
+        print(f"Attachment cache error: {e}")
+        return None
+
+def _cached_text_for_part(cur, message_id, part_id):
+    cur.execute("""
+        SELECT t.text FROM email_attachments a
+        JOIN attachment_text t ON t.content_hash = a.content_hash
+        WHERE a.message_id = %s AND a.part_id = %s
+    """, (message_id, part_id))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _cached_text_for_hash(cur, content_hash):
+    cur.execute("SELECT text FROM attachment_text WHERE content_hash = %s", (content_hash,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _store_text(cur, message_id, part, content_hash, text):
+    cur.execute("""
+        INSERT INTO attachment_text (content_hash, text) VALUES (%s, %s)
+        ON CONFLICT (content_hash) DO NOTHING;
+    """, (content_hash, text))
+    cur.execute("""
+        INSERT INTO email_attachments (message_id, part_id, attachment_id, filename, mime_type, size, content_hash)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (message_id, part_id) DO UPDATE SET content_hash = EXCLUDED.content_hash;
+    """, (message_id, part['part_id'], part['attachment_id'], part['filename'],
+          part['mime_type'], part['size'], content_hash))
+
+def load_attachment_text(service, message_id, part):
+    """Return the text of one attachment part, downloading it only on a cache miss."""
+    if part['mime_type'] not in SUPPORTED_MIME_TYPES or part['size'] > MAX_ATTACHMENT_BYTES:
+        return ""
+
+    cached = _db_call(_cached_text_for_part, message_id, part['part_id'])
+    if cached is not None:
+        return cached
+
+    attachment = service.users().messages().attachments().get(
+        userId='me',
+        messageId=message_id,
+        id=part['attachment_id']
+    ).execute()
+    data = base64.urlsafe_b64decode(attachment.get('data', ''))
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    # The same PDF is often attached to several issues, so reuse text by content
+    text = _db_call(_cached_text_for_hash, content_hash)
+    if text is None:
+        try:
+            text = extract_text(data, part['mime_type'])
+        except Exception as e:
+            print(f"Error extracting text from {part['filename'] or part['part_id']}: {e}")
+            return ""
+    _db_call(_store_text, message_id, part, content_hash, text)
+    return text
+
+def load_message_attachment_text(service, message_id, parts):
+    """Return the text to summarize from a message's attachment parts, fetching as few as possible.
+
+    The first text/plain part with content wins, then text/html: in a
+    multipart/alternative newsletter they are two copies of the same content.
+    PDFs are only downloaded when no inline text is available.
+    """
+    for mime_type in INLINE_MIME_TYPES:
+        for part in parts:
+            if part['mime_type'] == mime_type:
+                text = load_attachment_text(service, message_id, part)
+                if text:
+                    return text
+
+    text = ""
+    for part in parts:
+        if part['mime_type'] == 'application/pdf':
+            text += load_attachment_text(service, message_id, part) + "\n"
+            if len(text) >= MAX_TEXT_CHARS:
+                break
+    return text[:MAX_TEXT_CHARS].strip()
+
+def get_stored_attachment_parts(email_id):
+    """Return (message_id, parts) recorded at sync time for a stored email."""
+    def query(cur):
+        cur.execute("""
+            SELECT message_id, part_id, attachment_id, filename, mime_type, size
+            FROM email_attachments
+            WHERE email_id = %s
+            ORDER BY id
+        """, (email_id,))
+        return cur.fetchall()
+
+    rows = _db_call(query) or []
+    if not rows:
+        return None, []
+    parts = [
+        {'part_id': r[1], 'attachment_id': r[2], 'filename': r[3], 'mime_type': r[4], 'size': r[5] or 0}
+        for r in rows
+    ]
+    return rows[0][0], parts
@@ -0,0 +1,288 @@
+import re
+import threading
+import zlib
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from app.models.schema import DB_CONFIG, ensure_schema
+from app.services.archive_service import decompress_body, get_dictionary
+
+# Size of the hashed feature space; vectors are stored sparse, so this only bounds collisions
+EMBEDDING_DIM = 2 ** 18
+BACKFILL_BATCH_SIZE = 256
+# Only the start of a body is embedded, which is where newsletters put their headlines
+MAX_EMBED_CHARS = 20000
+# Stored email vectors keep only their heaviest features, so a row stays smaller than the
+# compressed body it indexes and search cost does not grow with body length
+MAX_DOCUMENT_FEATURES = 256
+# Bump when tokenize or the stored encoding changes; backfill_embeddings re-embeds older rows
+EMBEDDING_FORMAT = 2
+
+TOKEN_PATTERN = re.compile(r"\w\w+", re.UNICODE)
+
+# English and Italian function words carry no topic and only add noise to cosine scores
+STOPWORDS = frozenset("""
+    a about after all also an and any are as at be been but by can could did do does for from
+    had has have he her his how if in into is it its just more most my new no not now of on one
+    or our out over she so some than that the their them then there these they this to up us was
+    we were what when which who why will with would you your
+    ad al alla alle anche che chi ci come con da dal dalla del della delle dei di e ed gli ha hanno
+    il in la le lo ma mi ne nei nel nella non o per più se si sono su sul sulla tra un una uno
+""".split())
+
+# Longest suffixes first; a light stemmer so "regulation", "regulate" and "regulatory" meet
+SUFFIXES = sorted("""
+    ational ations ation atory ators ator ating ated ates ate ements ement ments ment ness ings ing
+    ities ity ives ive izes ized ize ises ised ise ical ically ally ful ous ers er ies ied ed es ly al s
+""".split(), key=len, reverse=True)
+
+# In-process sparse index: per-email features plus the flattened arrays searched at query time
+_index_lock = threading.Lock()
+_index = {
+    'docs': {},
+    'versions': {},
+    'last_version': 0,
+    'ids': np.empty(0, dtype=np.int64),
+    'rows': np.empty(0, dtype=np.int32),
+    'cols': np.empty(0, dtype=np.int32),
+    'vals': np.empty(0, dtype=np.float32),
+    'idf': None,
+    'norms': None,
+}
+
+def stem(word):
+    """Strip the longest common English suffix, keeping at least a three-letter stem."""
+    if word.endswith('ss'):
+        return word
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+def tokenize(text, bigrams=True):
+    """Return the features of a text: word stems, optionally followed by stem bigrams."""
+    stems = [stem(w) for w in TOKEN_PATTERN.findall(text.lower()) if w not in STOPWORDS]
+    if bigrams:
+        return stems + [f"{a} {b}" for a, b in zip(stems, stems[1:])]
+    return stems
+
+def embed_texts(texts, bigrams=True, max_features=None):
+    """Embed a batch of texts as L2-normalised sparse hashed term-frequency vectors.
+
+    Returns one (feature_ids, weights) pair of arrays per text. Features are hashed
+    with crc32 so vectors are stable across processes. IDF weighting is applied at
+    query time from the index itself, which keeps stored vectors valid as the
+    corpus grows. Paraphrases rarely share word pairs, so comparisons between
+    short texts can leave bigrams out. With max_features, each text keeps only
+    its most frequent features.
+    """
+    rows, cols = [], []
+    for row, text in enumerate(texts):
+        features = tokenize(text[:MAX_EMBED_CHARS], bigrams)
+        rows.extend([row] * len(features))
+        cols.extend(zlib.crc32(feature.encode('utf-8')) % EMBEDDING_DIM for feature in features)
+
+    # Count duplicate (text, feature) pairs for the whole batch at once
+    keys = np.array(rows, dtype=np.int64) * EMBEDDING_DIM + np.array(cols, dtype=np.int64)
+    keys, counts = np.unique(keys, return_counts=True)
+    values = np.log1p(counts).astype(np.float32)
+    key_rows = keys // EMBEDDING_DIM
+
+    if max_features is not None:
+        # Rank features within each text by weight (ties by feature id) and keep the top ones.
+        # The sort never moves a feature to another text, so each text's block starts where it did.
+        order = np.lexsort((keys, -values, key_rows))
+        rank = np.arange(len(order)) - np.searchsorted(key_rows, key_rows[order])
+        keep = np.sort(order[rank < max_features])
+        keys, values, key_rows = keys[keep], values[keep], key_rows[keep]
+
+    norms = np.sqrt(np.bincount(key_rows, weights=values ** 2, minlength=len(texts)))
+    norms[norms == 0] = 1.0
+    values /= norms[key_rows].astype(np.float32)
+
+    bounds = np.searchsorted(key_rows, np.arange(len(texts) + 1))
+    return [
+        ((keys[start:stop] % EMBEDDING_DIM).astype(np.int32), values[start:stop])
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+
+def encode_vector(vector, dtype=np.float16):
+    """Serialise a sparse vector as its int32 feature ids followed by its weights as dtype.
+
+    Normalised weights lie in [0, 1], where float16 is precise enough for ranking.
+    """
+    feature_ids, weights = vector
+    return feature_ids.astype(np.int32).tobytes() + weights.astype(dtype).tobytes()
+
+def decode_vector(data, dtype=np.float16):
+    """Inverse of encode_vector; weights come back as float32."""
+    data = bytes(data)
+    split = len(data) // (4 + np.dtype(dtype).itemsize) * 4
+    return np.frombuffer(data[:split], dtype=np.int32), np.frombuffer(data[split:], dtype=dtype).astype(np.float32)
+
+def email_text(sender, subject, body):
+    """Build the text that represents an email in the index."""
+    return f"{subject or ''}\n{sender or ''}\n{body or ''}"
+
+def store_embeddings(cur, emails):
+    """Embed (email_id, text) pairs in one batch and upsert them."""
+    if not emails:
+        return
+    vectors = embed_texts([text for _, text in emails], max_features=MAX_DOCUMENT_FEATURES)
+    execute_values(cur, """
+        INSERT INTO email_embeddings (email_id, features, format) VALUES %s
+        ON CONFLICT (email_id) DO UPDATE
+        SET features = EXCLUDED.features, format = EXCLUDED.format, version = EXCLUDED.version
+    """, [(email_id, psycopg2.Binary(encode_vector(vector)), EMBEDDING_FORMAT)
+          for (email_id, _), vector in zip(emails, vectors)])
+
+def backfill_embeddings(batch_size=BACKFILL_BATCH_SIZE):
+    """Embed every stored email that has no embedding, or one in an older format, in batches."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        cur = conn.cursor()
+
+        total = 0
+        while True:
+            cur.execute("""
+                SELECT e.id, e.sender, e.subject, e.body, a.body_compressed, a.dictionary_id
+                FROM emails e
+                LEFT JOIN email_archive a ON a.email_id = e.id
+                LEFT JOIN email_embeddings v ON v.email_id = e.id
+                WHERE v.email_id IS NULL OR v.format < %s
+                ORDER BY e.id
+                LIMIT %s
+            """, (EMBEDDING_FORMAT, batch_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            emails = []
+            for email_id, sender, subject, body, body_compressed, dictionary_id in rows:
+                if body_compressed is not None:
+                    body = decompress_body(body_compressed, get_dictionary(cur, dictionary_id))
+                emails.append((email_id, email_text(sender, subject, body)))
+
+            store_embeddings(cur, emails)
+            conn.commit()
+            total += len(rows)
+            print(f"Embedded {total} emails so far")
+
+        cur.close()
+        return total
+
+    except Exception as e:
+        conn.rollback()
+        print(f"Embedding backfill error: {e}")
+        raise
+    finally:
+        conn.close()
+
+def _refresh_index(cur):
+    """Bring the in-process index up to date with email_embeddings.
+
+    Every write gets a new version from a sequence, so normally only rows newer
+    than the last one loaded are read; that picks up backfilled old emails and
+    re-embeddings too. The row count and version sum act as a fingerprint: if
+    they still disagree afterwards (a delete, or a write that committed out of
+    sequence order), the index is reloaded in full.
+    """
+    cur.execute("SELECT count(*), COALESCE(sum(version), 0) FROM email_embeddings WHERE format = %s",
+                (EMBEDDING_FORMAT,))
+    fingerprint = tuple(int(v) for v in cur.fetchone())
+    if _index['idf'] is not None and fingerprint == _index_fingerprint():
+        return
+
+    _load_embeddings(cur, _index['last_version'])
+    if fingerprint != _index_fingerprint():
+        _index['docs'].clear()
+        _index['versions'].clear()
+        _load_embeddings(cur, 0)
+    _rebuild_index()
+
+def _index_fingerprint():
+    return len(_index['versions']), sum(_index['versions'].values())
+
+def _load_embeddings(cur, after_version):
+    cur.execute("""
+        SELECT email_id, features, version FROM email_embeddings
+        WHERE version > %s AND format = %s
+        ORDER BY version
+    """, (after_version, EMBEDDING_FORMAT))
+    for email_id, features, version in cur.fetchall():
+        _index['docs'][email_id] = decode_vector(features)
+        _index['versions'][email_id] = version
+        _index['last_version'] = max(_index['last_version'], version)
+
+def _rebuild_index():
+    """Flatten per-email vectors into COO arrays and recompute IDF and row norms.
+
+    Everything here is linear in the number of stored features, not in
+    emails x EMBEDDING_DIM, and only runs when the index changed.
+    """
+    docs = _index['docs']
+    ids = np.array(sorted(docs), dtype=np.int64)
+    lengths = [len(docs[email_id][0]) for email_id in ids]
+    cols = np.concatenate([docs[email_id][0] for email_id in ids]) if len(ids) else np.empty(0, dtype=np.int32)
+    vals = np.concatenate([docs[email_id][1] for email_id in ids]) if len(ids) else np.empty(0, dtype=np.float32)
+    rows = np.repeat(np.arange(len(ids), dtype=np.int32), lengths)
+
+    doc_freq = np.bincount(cols, minlength=EMBEDDING_DIM)
+    idf = (np.log((1 + len(ids)) / (1 + doc_freq)) + 1).astype(np.float32)
+    norms = np.sqrt(np.bincount(rows, weights=(vals * idf[cols]) ** 2, minlength=len(ids)))
+    norms[norms == 0] = 1.0
+
+    _index.update(ids=ids, rows=rows, cols=cols, vals=vals, idf=idf, norms=norms)
+
+def get_idf():
+    """Return the IDF weights of the indexed email corpus, one per hashed feature."""
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with _index_lock:
+            _refresh_index(conn.cursor())
+            return _index['idf']
+    finally:
+        conn.close()
+
+def semantic_search(query, top_k=10, keyword_ids=None, keyword_weight=0.3):
+    """Return [(email_id, score)] for the top_k emails by cosine similarity to the query.
+
+    When keyword_ids is given (hybrid mode), emails that also matched a keyword
+    search get keyword_weight blended into their score.
+    """
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        with _index_lock:
+            _refresh_index(conn.cursor())
+            index = dict(_index)
+    finally:
+        conn.close()
+
+    ids, rows, cols, vals, idf = index['ids'], index['rows'], index['cols'], index['vals'], index['idf']
+    if not len(ids):
+        return []
+
+    # Scatter the IDF-weighted query into a dense lookup, then score only matching features
+    query_ids, query_weights = embed_texts([query])[0]
+    query_vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    query_vector[query_ids] = query_weights * idf[query_ids]
+    query_norm = np.linalg.norm(query_vector)
+    if query_norm == 0:
+        return []
+
+    matches = query_vector[cols] != 0
+    contributions = vals[matches] * idf[cols[matches]] * query_vector[cols[matches]]
+    scores = np.bincount(rows[matches], weights=contributions, minlength=len(ids)) / (index['norms'] * query_norm)
+
+    if keyword_ids:
+        keyword_mask = np.isin(ids, np.fromiter(keyword_ids, dtype=np.int64))
+        scores = (1 - keyword_weight) * scores + keyword_weight * keyword_mask
+
+    top_k = min(top_k, len(ids))
+    top = np.argpartition(-scores, top_k - 1)[:top_k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+if __name__ == "__main__":
+    ensure_schema()
+    backfill_embeddings()
@@ -10,6 +10,19 @@ from googleapiclient.discovery import build
 from bs4 import BeautifulSoup
 import openai
 import json
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from app.models.schema import ensure_schema
+from app.services.archive_service import read_email_body
+from app.services.embedding_service import email_text, store_embeddings
+from app.services.digest_service import record_summary, update_digest
+from app.services.llm_queue import dispatcher, SCHEDULED
+from app.services.attachment_service import (
+    collect_attachment_parts,
+    record_attachment_parts,
+    get_stored_attachment_parts,
+    load_message_attachment_text
+)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -132,6 +145,7 @@ def fetch_emails():
         return
 
     email_data = []
+    attachments = []
 
     for message in messages:
         msg = service.users().messages().get(userId='me', id=message['id']).execute()
@@ -150,27 +164,44 @@ def fetch_emails():
         # Extract email body
         email_body = extract_plain_text(payload)
 
+        # Attachment bytes are only fetched later, if needed for summarization
+        attachment_parts = collect_attachment_parts(payload)
+
         print("=" * 50)
         print(f"From: {email_from}")
         print(f"Subject: {email_subject}")
         print(f"Body length: {len(email_body)} characters")
+        print(f"Attachment parts: {len(attachment_parts)}")
         print("=" * 50)
 
         email_data.append((email_from, email_subject, email_body))
+        attachments.append((message['id'], attachment_parts))
+
+    store_emails_in_db(email_data, attachments)
 
-    store_emails_in_db(email_data)
+def store_emails_in_db(email_data, attachments=None):
+    """Store extracted emails in PostgreSQL database.
 
-def store_emails_in_db(email_data):
-    """Store extracted emails in PostgreSQL database."""
+    attachments, when given, holds a (message_id, parts) pair for each email.
+    """
     try:
         conn = psycopg2.connect(**DB_CONFIG)
         cur = conn.cursor()
 
+        stored = []
         for email in email_data:
             cur.execute("""
                 INSERT INTO emails (sender, subject, body)
-                VALUES (%s, %s, %s);
+                VALUES (%s, %s, %s)
+                RETURNING id;
             """, email)
+            stored.append((cur.fetchone()[0], email_text(*email)))
+
+        for (email_id, _), (message_id, parts) in zip(stored, attachments or []):
+            record_attachment_parts(cur, email_id, message_id, parts)
+
+        # Embed the whole batch at once for semantic search
+        store_embeddings(cur, stored)
 
         conn.commit()
         cur.close()
@@ -200,28 +231,74 @@ def search_emails(query):
     emails = [{"id": row[0], "sender": row[1], "subject": row[2], "received_at": row[3]} for row in results]
     return emails
 
-def summarize_email(email_id):
-    """Fetch email content and summarize it using OpenAI."""
+def summarize_email(email_id, priority=SCHEDULED):
+    """Fetch email content and summarize it using OpenAI.
+
+    Batch callers should pass priority=BACKFILL so they never delay interactive summaries.
+    """
     conn = psycopg2.connect(**DB_CONFIG)
     cur = conn.cursor()
-    cur.execute("SELECT body FROM emails WHERE id = %s", (email_id,))
-    email_body = cur.fetchone()
+    email_body = read_email_body(cur, email_id)
     cur.close()
     conn.close()
 
-    if not email_body:
+    if email_body is None:
         return "No email found with the given ID."
+
+    # Newsletters delivered as attachments have no inline body
+    if not email_body.strip():
+        message_id, parts = get_stored_attachment_parts(email_id)
+        if parts:
+            email_body = load_message_attachment_text(authenticate_gmail(), message_id, parts)
+        if not email_body:
+            return "No email content found to summarize."
     
     # Send to OpenAI for summarization
-    response = openai.ChatCompletion.create(
+    response = dispatcher.complete(
+        priority,
         model="gpt-4-turbo",
         messages=[
             {"role": "system", "content": "Summarize the following email content:"},
-            {"role": "user", "content": email_body[0]}
+            {"role": "user", "content": email_body}
         ]
     )
     
-    return response['choices'][0]['message']['content']
+    summary = response['choices'][0]['message']['content']
+    record_summary(email_id, summary)
+    return summary
+
+def summarize_stored_emails(digest_date=None, priority=SCHEDULED):
+    """Summarize the day's stored emails that have no summary yet, then refresh its digest.
+
+    Summaries are requested concurrently through the LLM dispatcher, which keeps
+    them behind any interactive traffic and within the shared token budget.
+    """
+    digest_date = digest_date or date.today()
+    conn = psycopg2.connect(**DB_CONFIG)
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id FROM emails
+        WHERE summary IS NULL AND COALESCE(received_at, NOW())::date = %s
+        ORDER BY id
+    """, (digest_date,))
+    email_ids = [row[0] for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+
+    def summarize(email_id):
+        try:
+            summarize_email(email_id, priority)
+            return True
+        except Exception as e:
+            print(f"Error summarizing email {email_id}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=dispatcher.max_concurrency) as executor:
+        summarized = sum(executor.map(summarize, email_ids))
+
+    print(f"Summarized {summarized} of {len(email_ids)} emails for {digest_date}")
+    update_digest(digest_date)
+    return summarized
 
 def logout():
     """Remove Gmail API credentials."""
@@ -288,7 +365,7 @@ def search_messages(service, query: str, label_id: str = None):
             body = ""
             if 'parts' in msg.get('payload', {}):
                 for part in msg['payload']['parts']:
-                    if part.get('mimeType') == 'text/plain':
+                    if part.get('mimeType') == 'text/plain' and part.get('body', {}).get('data'):
                         body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
                         break
             elif 'body' in msg.get('payload', {}):
@@ -337,4 +414,6 @@ def search_messages(service, query: str, label_id: str = None):
         raise e
 
 if __name__ == "__main__":
+    ensure_schema()
     fetch_emails()
+    summarize_stored_emails()
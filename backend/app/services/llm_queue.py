@@ -0,0 +1,272 @@
+import os
+import time
+import asyncio
+import heapq
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+openai.api_key = os.getenv('OPENAI_API_KEY')
+
+# Priority classes, lower runs first
+INTERACTIVE = 0
+SCHEDULED = 1
+BACKFILL = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', SCHEDULED: 'scheduled', BACKFILL: 'backfill'}
+
+MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '90000'))
+# A user who clicked "summarize" this long ago has given up waiting
+INTERACTIVE_DEADLINE_SECONDS = float(os.getenv('LLM_INTERACTIVE_DEADLINE_SECONDS', '30'))
+# Budget scheduled and backfill jobs may not spend, so a user's request can start right away
+INTERACTIVE_RESERVE_TOKENS = int(os.getenv('LLM_INTERACTIVE_RESERVE_TOKENS', '10000'))
+
+LATENCY_SAMPLES = 500
+
+class LLMJobExpired(Exception):
+    """Raised for a job whose deadline passed before it could be dispatched."""
+
+class LLMDispatcher:
+    """Central queue for OpenAI chat completions.
+
+    Jobs are served strictly by priority class from a shared pool of worker
+    threads, and a token bucket refilled at TOKENS_PER_MINUTE keeps the combined
+    traffic under the rate limit. Interactive jobs start whenever the bucket has
+    budget. Scheduled and backfill jobs only start if paying their estimate
+    leaves reserve_tokens in the bucket, and never occupy the last worker, so a
+    batch of long newsletters cannot make a user's request wait for its debt.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY, tokens_per_minute=TOKENS_PER_MINUTE,
+                 reserve_tokens=INTERACTIVE_RESERVE_TOKENS):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.reserve_tokens = min(reserve_tokens, tokens_per_minute)
+        # One worker is always left for interactive jobs, unless there is only one
+        self.max_bulk_concurrency = max(1, max_concurrency - 1)
+        # Pending jobs, the token bucket and the bulk job count share one condition
+        self._pending = []
+        self._sequence = itertools.count()
+        self._budget = float(tokens_per_minute)
+        self._budget_updated = time.monotonic()
+        self._bulk_running = 0
+        self._budget_lock = threading.Condition()
+        self._workers = []
+        self._workers_lock = threading.Lock()
+        # Counters are updated from the event loop, threadpool threads and workers
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            priority: {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0,
+                       'wait': deque(maxlen=LATENCY_SAMPLES), 'latency': deque(maxlen=LATENCY_SAMPLES)}
+            for priority in PRIORITY_NAMES
+        }
+
+    def submit(self, priority, deadline=None, **request):
+        """Queue a ChatCompletion request and return a Future for its response.
+
+        deadline is an absolute time.monotonic() value; interactive jobs get one
+        INTERACTIVE_DEADLINE_SECONDS from now unless a deadline is passed.
+        """
+        deadline = _default_deadline(priority, deadline)
+
+        self._start_workers()
+        future = Future()
+        job = {'request': request, 'future': future, 'deadline': deadline,
+               'submitted_at': time.monotonic(), 'tokens': estimate_tokens(request)}
+        self._record(priority, 'submitted')
+        with self._budget_lock:
+            heapq.heappush(self._pending, (priority, next(self._sequence), job))
+            self._budget_lock.notify_all()
+        return future
+
+    def complete(self, priority, deadline=None, **request):
+        """Submit a request and block until its response is ready.
+
+        Raises LLMJobExpired at the deadline if the job has not been dispatched by then.
+        """
+        deadline = _default_deadline(priority, deadline)
+        future = self.submit(priority, deadline, **request)
+        if deadline is None:
+            return future.result()
+        try:
+            return future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            self._expire(priority, future)
+            # Already dispatched: the tokens are spent, so wait for the answer
+            return future.result()
+
+    async def acomplete(self, priority, deadline=None, **request):
+        """Submit a request and await its response, with the same deadline handling as complete()."""
+        deadline = _default_deadline(priority, deadline)
+        future = self.submit(priority, deadline, **request)
+        wrapped = asyncio.wrap_future(future)
+        if deadline is None:
+            return await wrapped
+        try:
+            # Shield so the timeout does not cancel a job that is already running
+            return await asyncio.wait_for(asyncio.shield(wrapped), max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            self._expire(priority, future)
+            return await wrapped
+
+    def _expire(self, priority, future):
+        """Cancel a job whose caller stopped waiting; raise LLMJobExpired unless it already started."""
+        if future.cancel():
+            self._record(priority, 'dropped')
+            raise LLMJobExpired(
+                f"{PRIORITY_NAMES[priority]} job not dispatched before its deadline"
+            )
+
+    def stats(self):
+        """Per-class counters and latency percentiles in seconds."""
+        report = {}
+        for priority, name in PRIORITY_NAMES.items():
+            with self._stats_lock:
+                stats = dict(self._stats[priority], wait=list(self._stats[priority]['wait']),
+                             latency=list(self._stats[priority]['latency']))
+            report[name] = {
+                'submitted': stats['submitted'],
+                'completed': stats['completed'],
+                'failed': stats['failed'],
+                'dropped': stats['dropped'],
+                'queue_wait_p50': _percentile(stats['wait'], 50),
+                'queue_wait_p95': _percentile(stats['wait'], 95),
+                'latency_p50': _percentile(stats['latency'], 50),
+                'latency_p95': _percentile(stats['latency'], 95),
+            }
+        with self._budget_lock:
+            report['queued'] = len(self._pending)
+            report['token_budget'] = round(self._refill(), 1)
+        return report
+
+    def _record(self, priority, counter=None, **samples):
+        """Bump a per-class counter and/or append latency samples under the stats lock."""
+        with self._stats_lock:
+            stats = self._stats[priority]
+            if counter:
+                stats[counter] += 1
+            for name, value in samples.items():
+                stats[name].append(value)
+
+    def _start_workers(self):
+        with self._workers_lock:
+            while len(self._workers) < self.max_concurrency:
+                worker = threading.Thread(target=self._work, daemon=True,
+                                          name=f"llm-worker-{len(self._workers)}")
+                worker.start()
+                self._workers.append(worker)
+
+    def _refill(self):
+        """Top up the token bucket for the time elapsed. Caller must hold _budget_lock."""
+        now = time.monotonic()
+        self._budget = min(
+            float(self.tokens_per_minute),
+            self._budget + (now - self._budget_updated) * self.tokens_per_minute / 60
+        )
+        self._budget_updated = now
+        return self._budget
+
+    def _take_job(self):
+        """Block until the next job may start, then dequeue it and spend its estimate.
+
+        Returns (priority, job, expired); expired jobs are dequeued without
+        spending anything so they never hold up the jobs behind them.
+        """
+        with self._budget_lock:
+            while True:
+                budget = self._refill()
+                timeout = None
+                if self._pending:
+                    priority, _, job = self._pending[0]
+                    if job['future'].cancelled():
+                        heapq.heappop(self._pending)
+                        continue
+                    if job['deadline'] is not None and time.monotonic() > job['deadline']:
+                        heapq.heappop(self._pending)
+                        return priority, job, True
+
+                    if priority == INTERACTIVE:
+                        # Interactive jobs may overdraw the bucket; usage is settled afterwards
+                        required = 0.0
+                        ready = budget > 0
+                    else:
+                        # A job larger than the whole bucket still runs once it is full
+                        required = min(float(self.tokens_per_minute), self.reserve_tokens + job['tokens'])
+                        ready = budget >= required
+                    bulk_blocked = priority != INTERACTIVE and self._bulk_running >= self.max_bulk_concurrency
+
+                    if ready and not bulk_blocked:
+                        heapq.heappop(self._pending)
+                        if not job['future'].set_running_or_notify_cancel():
+                            continue
+                        self._budget -= job['tokens']
+                        if priority != INTERACTIVE:
+                            self._bulk_running += 1
+                        return priority, job, False
+
+                    if not ready:
+                        # Sleep roughly until the deficit has been refilled
+                        timeout = (required - budget) * 60 / self.tokens_per_minute + 0.01
+                    if job['deadline'] is not None:
+                        timeout = min(timeout or float('inf'), max(0.0, job['deadline'] - time.monotonic()) + 0.01)
+                self._budget_lock.wait(timeout=timeout)
+
+    def _finish_job(self, priority, refund):
+        """Settle a finished job's estimate with its actual usage and free its slot."""
+        with self._budget_lock:
+            self._refill()
+            self._budget += refund
+            if priority != INTERACTIVE:
+                self._bulk_running -= 1
+            self._budget_lock.notify_all()
+
+    def _work(self):
+        while True:
+            priority, job, expired = self._take_job()
+            started_at = time.monotonic()
+
+            if expired:
+                if job['future'].set_running_or_notify_cancel():
+                    self._record(priority, 'dropped')
+                    job['future'].set_exception(LLMJobExpired(
+                        f"{PRIORITY_NAMES[priority]} job expired after {started_at - job['submitted_at']:.1f}s in queue"
+                    ))
+                continue
+
+            self._record(priority, wait=started_at - job['submitted_at'])
+            refund = 0
+            try:
+                response = openai.ChatCompletion.create(**job['request'])
+                used = response.get('usage', {}).get('total_tokens', job['tokens'])
+                refund = job['tokens'] - used
+                self._record(priority, 'completed')
+                job['future'].set_result(response)
+            except Exception as e:
+                self._record(priority, 'failed')
+                job['future'].set_exception(e)
+            finally:
+                self._finish_job(priority, refund)
+                self._record(priority, latency=time.monotonic() - job['submitted_at'])
+
+def _default_deadline(priority, deadline):
+    if deadline is None and priority == INTERACTIVE:
+        return time.monotonic() + INTERACTIVE_DEADLINE_SECONDS
+    return deadline
+
+def estimate_tokens(request):
+    """Rough token cost of a request: about four characters per prompt token plus the output cap."""
+    prompt_chars = sum(len(message.get('content', '')) for message in request.get('messages', []))
+    return prompt_chars // 4 + request.get('max_tokens', 500)
+
+def _percentile(samples, percent):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+    return round(ordered[index], 3)
+
+dispatcher = LLMDispatcher()
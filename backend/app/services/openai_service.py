@@ -1,6 +1,7 @@
 import openai
 import os
 from dotenv import load_dotenv
+from app.services.llm_queue import dispatcher, INTERACTIVE, LLMJobExpired
 
 load_dotenv()
 openai.api_key = os.getenv('OPENAI_API_KEY')
@@ -25,7 +26,8 @@ async def get_summary(subject: str, body: str) -> str:
         max_chars = 2000
         truncated_body = cleaned_body[:max_chars] + "..." if len(cleaned_body) > max_chars else cleaned_body
 
-        response = openai.ChatCompletion.create(
+        response = await dispatcher.acomplete(
+            INTERACTIVE,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "Create a concise summary focusing only on the most important points. If this is a forwarded email, focus on the main content. Maintain the original language of the content."},
@@ -36,5 +38,8 @@ async def get_summary(subject: str, body: str) -> str:
         )
         
         return response['choices'][0]['message']['content']
+    except LLMJobExpired:
+        # Let the route report a timeout rather than showing it as summary text
+        raise
     except Exception as e:
         return f"Error summarizing email: {str(e)}"  # Return error message instead of raising 
\ No newline at end of file
@@ -6,6 +6,7 @@ import uvicorn
 import requests
 from dotenv import load_dotenv
 from app.api.routes import router
+from app.models.schema import ensure_schema
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +26,9 @@ if not bucket_name:
 
 bucket = storage_client.bucket(bucket_name)
 
+# Create the tables and columns the services rely on before serving any request
+ensure_schema()
+
 app = FastAPI(title="Newsletter Summarizer API")
 
 # Configure CORS